@@ -7,6 +7,7 @@ from setuptools.command.develop import develop  # type: ignore
 import os
 import urllib
 import shutil
+import tempfile
 
 
 FMAP_dst = "./up_fmap/FMAP"
@@ -19,23 +20,42 @@ long_description = """==========================================================
     UP_FMAP
  ============================================================
 """
-isExist = os.path.exists("up_fmap")
-if not isExist:
-    os.system("mkdir up_fmap")
+os.makedirs("up_fmap", exist_ok=True)
 
 
 def install_FMAP():
-    subprocess.run(["git", "clone", "-b", FMAP_TAG, FMAP_REPO])
-    shutil.move(FMAP_PUBLIC, FMAP_dst)
-    curr_dir = os.getcwd()
-    os.chdir(FMAP_dst)
-    # subprocess.run(COMPILE_CMD)
-    os.system("rm -r out 2> /dev/null")
-    os.system("rm -r fmap-dist 2> /dev/null")
-    os.system("mkdir fmap-dist")
-    # os.system('cp -r libs/ enhsp-dist/')
-    os.system("cp FMAP.jar fmap-dist/")
-    os.chdir(curr_dir)
+    # Nothing to do if FMAP was already installed (e.g. by a previous build)
+    if os.path.isfile(os.path.join(FMAP_dst, "fmap-dist", "FMAP.jar")):
+        return
+    # FMAP is prepared in a private directory and then renamed, so that
+    # concurrent builds never see (or clone over) a partial installation
+    staging = tempfile.mkdtemp(dir="up_fmap", prefix=".fmap-")
+    try:
+        clone_dir = os.path.join(staging, FMAP_PUBLIC)
+        subprocess.run(
+            ["git", "clone", "--depth", "1", "-b", FMAP_TAG, FMAP_REPO, clone_dir],
+            check=True,
+        )
+        # subprocess.run(COMPILE_CMD)
+        shutil.rmtree(os.path.join(clone_dir, "out"), ignore_errors=True)
+        shutil.rmtree(os.path.join(clone_dir, "fmap-dist"), ignore_errors=True)
+        os.mkdir(os.path.join(clone_dir, "fmap-dist"))
+        shutil.copy(
+            os.path.join(clone_dir, "FMAP.jar"), os.path.join(clone_dir, "fmap-dist")
+        )
+        if os.path.isdir(FMAP_dst) and not os.path.isfile(
+            os.path.join(FMAP_dst, "fmap-dist", "FMAP.jar")
+        ):
+            # Left by an interrupted installation
+            shutil.rmtree(FMAP_dst, ignore_errors=True)
+        try:
+            os.rename(clone_dir, FMAP_dst)
+        except OSError:
+            # Another build installed FMAP first
+            if not os.path.isfile(os.path.join(FMAP_dst, "fmap-dist", "FMAP.jar")):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
 
 
 class InstallFMAP(build_py):
@@ -62,6 +82,7 @@ setup(
     author_email="onaindia@dsic.upv.es",
     packages=["up_fmap"],
     package_data={"": ["FMAP/FMAP.jar"]},
+    extras_require={"zstd": ["zstandard"]},
     cmdclass={"build_py": InstallFMAP, "develop": InstallFMAPdevelop},
     license="APACHE",
 )
@@ -3,235 +3,302 @@ from unified_planning.model.multi_agent import *  # type: ignore
 from collections import namedtuple  # type: ignore
 from unified_planning.io.ma_pddl_writer import MAPDDLWriter  # type: ignore
 from unified_planning.plans import PlanKind  # type: ignore
-from unittest import TestCase, main
+from unified_planning.engines.results import PlanGenerationResultStatus  # type: ignore
+from unified_planning.exceptions import UPUsageError  # type: ignore
+from unittest import TestCase, main, mock, skipIf
+from contextlib import contextmanager
+import asyncio
+import gc
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
 import pkg_resources
 from up_fmap import FMAPsolver
+from up_fmap import fmap_planner
+from up_fmap.fmap_planner import (
+    _cached_pddl,
+    _match_plan_lines,
+    _materialize_pddl,
+    _serialize_pddl,
+)
 
 # from ma_depot import get_example_problems  # type: ignore
 
 # Example = namedtuple("Example", ["problem", "plan"])
 
 
+def get_depot_problem():
+    # ma-depot
+    place = UserType("place")
+    locatable = UserType("locatable")
+    truck = UserType("truck", locatable)
+    hoist = UserType("hoist", locatable)
+    surface = UserType("surface", locatable)
+    pallet = UserType("pallet", surface)
+    crate = UserType("crate", surface)
+
+    # Fluents
+    pos = Fluent("pos", place=place)
+    at = Fluent("at", BoolType(), locatable=locatable, place=place)
+    on = Fluent("on", BoolType(), crate=crate, surface=surface)
+    In = Fluent("in", BoolType(), crate=crate, truck=truck)
+    clear = Fluent("clear", BoolType(), surface=surface)
+    available = Fluent("available", hoist=hoist)
+    lifting = Fluent("lifting", hoist=hoist, crate=crate)
+    driving = Fluent("driving", truck=truck)
+
+    # Actions
+    drive = InstantaneousAction("drive", x=truck, y=place, z=place)
+    x = drive.parameter("x")
+    y = drive.parameter("y")
+    z = drive.parameter("z")
+    drive.add_precondition(pos(y))
+    drive.add_precondition(at(x, y))
+    drive.add_precondition(driving(x))
+    drive.add_effect(pos(z), True)
+    drive.add_effect(pos(y), False)
+    drive.add_effect(at(x, z), True)
+    drive.add_effect(at(x, y), False)
+    lift = InstantaneousAction("lift", p=place, x=hoist, y=crate, z=surface)
+    p = lift.parameter("p")
+    x = lift.parameter("x")
+    y = lift.parameter("y")
+    z = lift.parameter("z")
+    lift.add_precondition(pos(p))
+    lift.add_precondition(at(x, p))
+    lift.add_precondition(available(x))
+    lift.add_precondition(at(y, p))
+    lift.add_precondition(on(y, z))
+    lift.add_precondition(clear(y))
+    lift.add_effect(lifting(x, y), True)
+    lift.add_effect(clear(z), True)
+    lift.add_effect(at(y, p), False)
+    lift.add_effect(clear(y), False)
+    lift.add_effect(available(x), False)
+    lift.add_effect(on(y, z), False)
+
+    drop = InstantaneousAction("drop", p=place, x=hoist, y=crate, z=surface)
+    p = drop.parameter("p")
+    x = drop.parameter("x")
+    y = drop.parameter("y")
+    z = drop.parameter("z")
+    drop.add_precondition(pos(p))
+    drop.add_precondition(at(x, p))
+    drop.add_precondition(at(z, p))
+    drop.add_precondition(clear(z))
+    drop.add_precondition(lifting(x, y))
+    drop.add_effect(available(x), True)
+    drop.add_effect(at(y, p), True)
+    drop.add_effect(clear(y), True)
+    drop.add_effect(on(y, z), True)
+    drop.add_effect(lifting(x, y), False)
+    drop.add_effect(clear(z), False)
+
+    load = InstantaneousAction("load", p=place, x=hoist, y=crate, z=truck)
+    p = load.parameter("p")
+    x = load.parameter("x")
+    y = load.parameter("y")
+    z = load.parameter("z")
+    load.add_precondition(pos(p))
+    load.add_precondition(at(x, p))
+    load.add_precondition(at(z, p))
+    load.add_precondition(lifting(x, y))
+    load.add_effect(In(y, z), True)
+    load.add_effect(available(x), True)
+    load.add_effect(lifting(x, y), False)
+
+    unload = InstantaneousAction("unload", p=place, x=hoist, y=crate, z=truck)
+    p = unload.parameter("p")
+    x = unload.parameter("x")
+    y = unload.parameter("y")
+    z = unload.parameter("z")
+    unload.add_precondition(pos(p))
+    unload.add_precondition(at(x, p))
+    unload.add_precondition(at(z, p))
+    unload.add_precondition(available(x))
+    unload.add_precondition(In(y, z))
+    unload.add_effect(lifting(x, y), True)
+    unload.add_effect(In(y, z), False)
+    unload.add_effect(available(x), False)
+
+    # Multi-Agent Problem
+    problem = MultiAgentProblem("depot")
+
+    # Environments
+    problem.ma_environment.add_fluent(at, default_initial_value=False)
+    problem.ma_environment.add_fluent(on, default_initial_value=False)
+    problem.ma_environment.add_fluent(In, default_initial_value=False)
+    problem.ma_environment.add_fluent(clear, default_initial_value=False)
+
+    # Agents
+    depot0_a = Agent("depot0_agent", problem)
+    distributor0_a = Agent("distributor0_agent", problem)
+    distributor1_a = Agent("distributor1_agent", problem)
+    driver0_a = Agent("driver0_agent", problem)
+    driver1_a = Agent("driver1_agent", problem)
+
+    # Agents - add actions
+    driver0_a.add_action(drive)
+    driver1_a.add_action(drive)
+
+    depot0_a.add_action(lift)
+    depot0_a.add_action(drop)
+    depot0_a.add_action(load)
+    depot0_a.add_action(unload)
+
+    distributor0_a.add_action(lift)
+    distributor0_a.add_action(drop)
+    distributor0_a.add_action(load)
+    distributor0_a.add_action(unload)
+
+    distributor1_a.add_action(lift)
+    distributor1_a.add_action(drop)
+    distributor1_a.add_action(load)
+    distributor1_a.add_action(unload)
+
+    # Agents - add fluents (private-predicates)
+    depot0_a.add_fluent(lifting, default_initial_value=False)
+    depot0_a.add_fluent(available, default_initial_value=False)
+
+    distributor0_a.add_fluent(lifting, default_initial_value=False)
+    distributor0_a.add_fluent(available, default_initial_value=False)
+
+    distributor1_a.add_fluent(lifting, default_initial_value=False)
+    distributor1_a.add_fluent(available, default_initial_value=False)
+
+    driver0_a.add_fluent(driving, default_initial_value=False)
+    driver1_a.add_fluent(driving, default_initial_value=False)
+
+    depot0_a.add_fluent(pos, default_initial_value=False)
+    distributor0_a.add_fluent(pos, default_initial_value=False)
+    distributor1_a.add_fluent(pos, default_initial_value=False)
+    driver0_a.add_fluent(pos, default_initial_value=False)
+    driver1_a.add_fluent(pos, default_initial_value=False)
+
+    # Add Agents to ma-problem
+    problem.add_agent(depot0_a)
+    problem.add_agent(distributor0_a)
+    problem.add_agent(distributor1_a)
+    problem.add_agent(driver0_a)
+    problem.add_agent(driver1_a)
+
+    # Objects
+    truck0 = Object("truck0", truck)
+    truck1 = Object("truck1", truck)
+    depot0_place = Object("depot0_place", place)
+    distributor0_place = Object("distributor0_place", place)
+    distributor1_place = Object("distributor1_place", place)
+    crate0 = Object("crate0", crate)
+    crate1 = Object("crate1", crate)
+    pallet0 = Object("pallet0", pallet)
+    pallet1 = Object("pallet1", pallet)
+    pallet2 = Object("pallet2", pallet)
+
+    hoist0 = Object("hoist0", hoist)
+    hoist1 = Object("hoist1", hoist)
+    hoist2 = Object("hoist2", hoist)
+
+    problem.add_object(crate0)
+    problem.add_object(crate1)
+    problem.add_object(truck0)
+    problem.add_object(truck1)
+    problem.add_object(depot0_place)
+    problem.add_object(distributor0_place)
+    problem.add_object(distributor1_place)
+    problem.add_object(pallet0)
+    problem.add_object(pallet1)
+    problem.add_object(pallet2)
+    problem.add_object(hoist0)
+    problem.add_object(hoist1)
+    problem.add_object(hoist2)
+
+    # Initial values
+    problem.set_initial_value(at(pallet0, depot0_place), True)
+    problem.set_initial_value(clear(crate1), True)
+    problem.set_initial_value(at(pallet1, distributor0_place), True)
+    problem.set_initial_value(clear(crate0), True)
+    problem.set_initial_value(at(pallet2, distributor1_place), True)
+    problem.set_initial_value(clear(pallet2), True)
+
+    problem.set_initial_value(at(truck0, distributor1_place), True)
+    problem.set_initial_value(at(truck1, depot0_place), True)
+    problem.set_initial_value(at(hoist0, depot0_place), True)
+    problem.set_initial_value(at(hoist1, distributor0_place), True)
+    problem.set_initial_value(at(hoist2, distributor1_place), True)
+    problem.set_initial_value(at(crate0, distributor0_place), True)
+    problem.set_initial_value(on(crate0, pallet1), True)
+    problem.set_initial_value(at(crate1, depot0_place), True)
+    problem.set_initial_value(on(crate1, pallet0), True)
+
+    problem.set_initial_value(Dot(driver0_a, pos(distributor1_place)), True)
+    problem.set_initial_value(Dot(driver1_a, pos(depot0_place)), True)
+    problem.set_initial_value(Dot(depot0_a, pos(depot0_place)), True)
+    problem.set_initial_value(Dot(depot0_a, available(hoist0)), True)
+    problem.set_initial_value(Dot(distributor0_a, available(hoist1)), True)
+    problem.set_initial_value(Dot(distributor1_a, available(hoist2)), True)
+
+    problem.set_initial_value(Dot(distributor0_a, pos(distributor0_place)), True)
+    problem.set_initial_value(Dot(distributor1_a, pos(distributor1_place)), True)
+
+    problem.set_initial_value(Dot(driver0_a, driving(truck0)), True)
+    problem.set_initial_value(Dot(driver1_a, driving(truck1)), True)
+
+    # Goals
+    problem.add_goal(on(crate0, pallet2))
+    problem.add_goal(on(crate1, pallet1))
+
+    return problem
+
+
+# Output of a stub java solving the depot problem
+STUB_PLAN = """
+echo "; Solution plan"
+echo "0: (drive driver0_agent truck0 distributor1_place depot0_place)"
+echo "1: (lift depot0_agent depot0_place hoist0 crate1 pallet0)"
+"""
+
+
+@contextmanager
+def stub_java(script: str):
+    """
+    Puts first in the PATH a java command running the given shell script, and
+    makes the planner believe that FMAP.jar is installed.
+    """
+    with tempfile.TemporaryDirectory() as bindir:
+        java = os.path.join(bindir, "java")
+        with open(java, "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(java, 0o755)
+        path = bindir + os.pathsep + os.environ.get("PATH", "")
+        with mock.patch.dict(os.environ, {"PATH": path}):
+            with mock.patch.object(fmap_planner, "_FMAP_JAR_FOUND", True):
+                yield bindir
+
+
+# Solves the depot problem in a new python process, checking that the MA-PDDL
+# is read from the on-disk cache instead of being written again
+NEW_PROCESS_SOLVE = """
+import sys
+from unittest import mock
+sys.path.insert(0, {test_dir!r})
+from test_up_fmap import get_depot_problem
+from up_fmap import fmap_planner
+with mock.patch.object(fmap_planner, "_FMAP_JAR_FOUND", True):
+    with mock.patch.object(fmap_planner, "MAPDDLWriter", side_effect=AssertionError):
+        result = fmap_planner.FMAPsolver(disk_cache=True).solve(get_depot_problem())
+print(result.status.name)
+"""
+
+
 class FMAPtest(TestCase):
     def test_fmap(self):
-        # ma-depot
-        place = UserType("place")
-        locatable = UserType("locatable")
-        truck = UserType("truck", locatable)
-        hoist = UserType("hoist", locatable)
-        surface = UserType("surface", locatable)
-        pallet = UserType("pallet", surface)
-        crate = UserType("crate", surface)
-
-        # Fluents
-        pos = Fluent("pos", place=place)
-        at = Fluent("at", BoolType(), locatable=locatable, place=place)
-        on = Fluent("on", BoolType(), crate=crate, surface=surface)
-        In = Fluent("in", BoolType(), crate=crate, truck=truck)
-        clear = Fluent("clear", BoolType(), surface=surface)
-        available = Fluent("available", hoist=hoist)
-        lifting = Fluent("lifting", hoist=hoist, crate=crate)
-        driving = Fluent("driving", truck=truck)
-
-        # Actions
-        drive = InstantaneousAction("drive", x=truck, y=place, z=place)
-        x = drive.parameter("x")
-        y = drive.parameter("y")
-        z = drive.parameter("z")
-        drive.add_precondition(pos(y))
-        drive.add_precondition(at(x, y))
-        drive.add_precondition(driving(x))
-        drive.add_effect(pos(z), True)
-        drive.add_effect(pos(y), False)
-        drive.add_effect(at(x, z), True)
-        drive.add_effect(at(x, y), False)
-        lift = InstantaneousAction("lift", p=place, x=hoist, y=crate, z=surface)
-        p = lift.parameter("p")
-        x = lift.parameter("x")
-        y = lift.parameter("y")
-        z = lift.parameter("z")
-        lift.add_precondition(pos(p))
-        lift.add_precondition(at(x, p))
-        lift.add_precondition(available(x))
-        lift.add_precondition(at(y, p))
-        lift.add_precondition(on(y, z))
-        lift.add_precondition(clear(y))
-        lift.add_effect(lifting(x, y), True)
-        lift.add_effect(clear(z), True)
-        lift.add_effect(at(y, p), False)
-        lift.add_effect(clear(y), False)
-        lift.add_effect(available(x), False)
-        lift.add_effect(on(y, z), False)
-
-        drop = InstantaneousAction("drop", p=place, x=hoist, y=crate, z=surface)
-        p = drop.parameter("p")
-        x = drop.parameter("x")
-        y = drop.parameter("y")
-        z = drop.parameter("z")
-        drop.add_precondition(pos(p))
-        drop.add_precondition(at(x, p))
-        drop.add_precondition(at(z, p))
-        drop.add_precondition(clear(z))
-        drop.add_precondition(lifting(x, y))
-        drop.add_effect(available(x), True)
-        drop.add_effect(at(y, p), True)
-        drop.add_effect(clear(y), True)
-        drop.add_effect(on(y, z), True)
-        drop.add_effect(lifting(x, y), False)
-        drop.add_effect(clear(z), False)
-
-        load = InstantaneousAction("load", p=place, x=hoist, y=crate, z=truck)
-        p = load.parameter("p")
-        x = load.parameter("x")
-        y = load.parameter("y")
-        z = load.parameter("z")
-        load.add_precondition(pos(p))
-        load.add_precondition(at(x, p))
-        load.add_precondition(at(z, p))
-        load.add_precondition(lifting(x, y))
-        load.add_effect(In(y, z), True)
-        load.add_effect(available(x), True)
-        load.add_effect(lifting(x, y), False)
-
-        unload = InstantaneousAction("unload", p=place, x=hoist, y=crate, z=truck)
-        p = unload.parameter("p")
-        x = unload.parameter("x")
-        y = unload.parameter("y")
-        z = unload.parameter("z")
-        unload.add_precondition(pos(p))
-        unload.add_precondition(at(x, p))
-        unload.add_precondition(at(z, p))
-        unload.add_precondition(available(x))
-        unload.add_precondition(In(y, z))
-        unload.add_effect(lifting(x, y), True)
-        unload.add_effect(In(y, z), False)
-        unload.add_effect(available(x), False)
-
-        # Multi-Agent Problem
-        problem = MultiAgentProblem("depot")
-
-        # Environments
-        problem.ma_environment.add_fluent(at, default_initial_value=False)
-        problem.ma_environment.add_fluent(on, default_initial_value=False)
-        problem.ma_environment.add_fluent(In, default_initial_value=False)
-        problem.ma_environment.add_fluent(clear, default_initial_value=False)
-
-        # Agents
-        depot0_a = Agent("depot0_agent", problem)
-        distributor0_a = Agent("distributor0_agent", problem)
-        distributor1_a = Agent("distributor1_agent", problem)
-        driver0_a = Agent("driver0_agent", problem)
-        driver1_a = Agent("driver1_agent", problem)
-
-        # Agents - add actions
-        driver0_a.add_action(drive)
-        driver1_a.add_action(drive)
-
-        depot0_a.add_action(lift)
-        depot0_a.add_action(drop)
-        depot0_a.add_action(load)
-        depot0_a.add_action(unload)
-
-        distributor0_a.add_action(lift)
-        distributor0_a.add_action(drop)
-        distributor0_a.add_action(load)
-        distributor0_a.add_action(unload)
-
-        distributor1_a.add_action(lift)
-        distributor1_a.add_action(drop)
-        distributor1_a.add_action(load)
-        distributor1_a.add_action(unload)
-
-        # Agents - add fluents (private-predicates)
-        depot0_a.add_fluent(lifting, default_initial_value=False)
-        depot0_a.add_fluent(available, default_initial_value=False)
-
-        distributor0_a.add_fluent(lifting, default_initial_value=False)
-        distributor0_a.add_fluent(available, default_initial_value=False)
-
-        distributor1_a.add_fluent(lifting, default_initial_value=False)
-        distributor1_a.add_fluent(available, default_initial_value=False)
-
-        driver0_a.add_fluent(driving, default_initial_value=False)
-        driver1_a.add_fluent(driving, default_initial_value=False)
-
-        depot0_a.add_fluent(pos, default_initial_value=False)
-        distributor0_a.add_fluent(pos, default_initial_value=False)
-        distributor1_a.add_fluent(pos, default_initial_value=False)
-        driver0_a.add_fluent(pos, default_initial_value=False)
-        driver1_a.add_fluent(pos, default_initial_value=False)
-
-        # Add Agents to ma-problem
-        problem.add_agent(depot0_a)
-        problem.add_agent(distributor0_a)
-        problem.add_agent(distributor1_a)
-        problem.add_agent(driver0_a)
-        problem.add_agent(driver1_a)
-
-        # Objects
-        truck0 = Object("truck0", truck)
-        truck1 = Object("truck1", truck)
-        depot0_place = Object("depot0_place", place)
-        distributor0_place = Object("distributor0_place", place)
-        distributor1_place = Object("distributor1_place", place)
-        crate0 = Object("crate0", crate)
-        crate1 = Object("crate1", crate)
-        pallet0 = Object("pallet0", pallet)
-        pallet1 = Object("pallet1", pallet)
-        pallet2 = Object("pallet2", pallet)
-
-        hoist0 = Object("hoist0", hoist)
-        hoist1 = Object("hoist1", hoist)
-        hoist2 = Object("hoist2", hoist)
-
-        problem.add_object(crate0)
-        problem.add_object(crate1)
-        problem.add_object(truck0)
-        problem.add_object(truck1)
-        problem.add_object(depot0_place)
-        problem.add_object(distributor0_place)
-        problem.add_object(distributor1_place)
-        problem.add_object(pallet0)
-        problem.add_object(pallet1)
-        problem.add_object(pallet2)
-        problem.add_object(hoist0)
-        problem.add_object(hoist1)
-        problem.add_object(hoist2)
-
-        # Initial values
-        problem.set_initial_value(at(pallet0, depot0_place), True)
-        problem.set_initial_value(clear(crate1), True)
-        problem.set_initial_value(at(pallet1, distributor0_place), True)
-        problem.set_initial_value(clear(crate0), True)
-        problem.set_initial_value(at(pallet2, distributor1_place), True)
-        problem.set_initial_value(clear(pallet2), True)
-
-        problem.set_initial_value(at(truck0, distributor1_place), True)
-        problem.set_initial_value(at(truck1, depot0_place), True)
-        problem.set_initial_value(at(hoist0, depot0_place), True)
-        problem.set_initial_value(at(hoist1, distributor0_place), True)
-        problem.set_initial_value(at(hoist2, distributor1_place), True)
-        problem.set_initial_value(at(crate0, distributor0_place), True)
-        problem.set_initial_value(on(crate0, pallet1), True)
-        problem.set_initial_value(at(crate1, depot0_place), True)
-        problem.set_initial_value(on(crate1, pallet0), True)
-
-        problem.set_initial_value(Dot(driver0_a, pos(distributor1_place)), True)
-        problem.set_initial_value(Dot(driver1_a, pos(depot0_place)), True)
-        problem.set_initial_value(Dot(depot0_a, pos(depot0_place)), True)
-        problem.set_initial_value(Dot(depot0_a, available(hoist0)), True)
-        problem.set_initial_value(Dot(distributor0_a, available(hoist1)), True)
-        problem.set_initial_value(Dot(distributor1_a, available(hoist2)), True)
-
-        problem.set_initial_value(Dot(distributor0_a, pos(distributor0_place)), True)
-        problem.set_initial_value(Dot(distributor1_a, pos(distributor1_place)), True)
-
-        problem.set_initial_value(Dot(driver0_a, driving(truck0)), True)
-        problem.set_initial_value(Dot(driver1_a, driving(truck1)), True)
-
-        # Goals
-        problem.add_goal(on(crate0, pallet2))
-        problem.add_goal(on(crate1, pallet1))
+        problem = get_depot_problem()
 
         with OneshotPlanner(name="fmap") as planner:
             result = planner.solve(problem)
@@ -244,3 +311,221 @@ class FMAPtest(TestCase):
         with OneshotPlanner(name="fmap") as planner:
             result = planner.solve(problem)
             self.assertEqual(result.status.name, "SOLVED_SATISFICING")
+
+    @skipIf(sys.platform == "win32", "the stub java is a shell script")
+    def test_stub_java(self):
+        problem = get_depot_problem()
+        hashing = mock.patch.object(
+            fmap_planner, "_problem_version", wraps=fmap_planner._problem_version
+        )
+        with stub_java(STUB_PLAN), FMAPsolver() as planner, hashing as version:
+            for _ in range(2):
+                result = planner.solve(problem)
+                self.assertEqual(
+                    result.status, PlanGenerationResultStatus.SOLVED_SATISFICING
+                )
+                self.assertEqual(len(result.plan.get_adjacency_list), 2)
+                # The problem is hashed once per solve
+                self.assertEqual(version.call_count, 1)
+                version.reset_mock()
+            output_stream = io.StringIO()
+            result = planner.solve(problem, output_stream=output_stream)
+            self.assertEqual(
+                result.status, PlanGenerationResultStatus.SOLVED_SATISFICING
+            )
+            self.assertIn("Solution plan", output_stream.getvalue())
+
+    @skipIf(sys.platform == "win32", "the stub java is a shell script")
+    def test_timeout(self):
+        problem = get_depot_problem()
+        with stub_java("sleep 30\n" + STUB_PLAN), FMAPsolver() as planner:
+            start = time.time()
+            result = planner.solve(problem, timeout=1)
+            self.assertEqual(result.status, PlanGenerationResultStatus.TIMEOUT)
+            self.assertIsNone(result.plan)
+            self.assertLess(time.time() - start, 10)
+
+    @skipIf(sys.platform == "win32", "the stub java is a shell script")
+    def test_cds_cache(self):
+        for version, supported in (("17.0.2", True), ("1.8.0_292", False)):
+            with self.subTest(version=version):
+                self._check_cds_cache(version, supported)
+
+    def _check_cds_cache(self, version: str, supported: bool):
+        problem = get_depot_problem()
+        script = (
+            f'[ "$1" = -version ] && echo \'java version "{version}"\' >&2 && exit\n'
+            'echo "$@" > "$(dirname "$0")/args"\n' + STUB_PLAN
+        )
+        with tempfile.TemporaryDirectory() as tempdir, stub_java(script) as bindir:
+            jar = os.path.join(tempdir, "FMAP.jar")
+            open(jar, "w").close()
+            cache_dir = os.path.join(tempdir, "cache")
+            with mock.patch.multiple(fmap_planner, _FMAP_JAR=jar, _CACHE_DIR=cache_dir):
+                for cds_cache in (False, True):
+                    with warnings.catch_warnings(record=True) as caught:
+                        warnings.simplefilter("always")
+                        with FMAPsolver(cds_cache=cds_cache) as planner:
+                            planner.solve(problem)
+                    with open(os.path.join(bindir, "args")) as f:
+                        args = f.read().split()
+                    # The CDS options (and the cache directory) are only used
+                    # when the CDS cache is enabled and java is 13 or later,
+                    # otherwise the option is ignored with a warning
+                    enabled = cds_cache and supported
+                    self.assertEqual(os.path.isdir(cache_dir), enabled)
+                    self.assertEqual("-Xlog:disable" in args, enabled)
+                    ignored = [w for w in caught if "cds_cache" in str(w.message)]
+                    self.assertEqual(bool(ignored), cds_cache and not supported)
+
+    @skipIf(sys.platform == "win32", "the stub java is a shell script")
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as cache_home, stub_java(STUB_PLAN):
+            cache_dir = os.path.join(cache_home, "up_fmap")
+            with mock.patch.object(fmap_planner, "_CACHE_DIR", cache_dir):
+                self._check_disk_cache(cache_home)
+
+    def _check_disk_cache(self, cache_home: str):
+        FMAPsolver.clear_cache()
+        fingerprint = fmap_planner._problem_fingerprint(get_depot_problem())
+        with FMAPsolver(disk_cache=True) as planner:
+            planner.solve(get_depot_problem())
+        entry = fmap_planner._disk_cache_lookup(fingerprint)
+        assert entry is not None
+        # The entry is compressed (and decompressed when used) with zstandard
+        self.assertEqual(entry.endswith(".zst"), fmap_planner.zstandard is not None)
+        # The entry is used by a new process
+        test_dir = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, XDG_CACHE_HOME=cache_home)
+        out = subprocess.run(
+            [sys.executable, "-c", NEW_PROCESS_SOLVE.format(test_dir=test_dir)],
+            env=env,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        self.assertEqual(out.decode().split(), ["SOLVED_SATISFICING"])
+        # Damaged or deleted entries are cache misses, and they are stored again
+        for damage in (
+            lambda: open(os.path.join(entry, "names.json"), "w").close(),
+            lambda: shutil.rmtree(os.path.join(entry, "problem_pddl")),
+            lambda: shutil.rmtree(entry),
+        ):
+            damage()
+            FMAPsolver.clear_cache()
+            with FMAPsolver(disk_cache=True) as planner:
+                result = planner.solve(get_depot_problem())
+            self.assertEqual(
+                result.status, PlanGenerationResultStatus.SOLVED_SATISFICING
+            )
+            self.assertEqual(fmap_planner._disk_cache_lookup(fingerprint), entry)
+        FMAPsolver.clear_cache()
+
+    @skipIf(not sys.platform.startswith("linux"), "named pipes are used on linux")
+    def test_fifo_feeder(self):
+        data = b"(define (domain depot))\n" * 100000
+        feeder = fmap_planner._FifoFeeder()
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = [os.path.join(tempdir, f"{i}.pddl") for i in range(3)]
+            for path in paths:
+                feeder.write(path, data)
+            with open(paths[0], "rb") as f:
+                self.assertEqual(f.read(), data)
+            with open(paths[1], "rb") as f:
+                self.assertEqual(f.read(10), data[:10])
+            # The pipes not (fully) read do not block close
+            feeder.close()
+
+    @skipIf(not sys.platform.startswith("linux"), "named pipes are used on linux")
+    def test_named_pipes_timeout(self):
+        with FMAPsolver(named_pipes=True) as planner:
+            with self.assertRaises(UPUsageError):
+                planner.solve(get_depot_problem())
+
+    def test_event_loop_closed_with_thread(self):
+        loops = []
+
+        def solve():
+            loops.append(fmap_planner._proactor_event_loop())
+            loops.append(fmap_planner._proactor_event_loop())
+
+        # The test runs the selector loop in place of the windows one
+        with mock.patch.object(
+            asyncio, "ProactorEventLoop", asyncio.SelectorEventLoop, create=True
+        ):
+            thread = threading.Thread(target=solve)
+            thread.start()
+            thread.join()
+        gc.collect()
+        # The loop is reused by the solves of the thread and closed with it
+        self.assertIs(loops[0], loops[1])
+        self.assertTrue(loops[0].is_closed())
+
+    def test_log_tail(self):
+        lines = ["a\n", "bb\n", "ccc\n"]
+        self.assertEqual(fmap_planner._log_tail(lines, None), "a\nbb\nccc\n")
+        self.assertEqual(fmap_planner._log_tail(lines, 9), "a\nbb\nccc\n")
+        self.assertEqual(fmap_planner._log_tail(lines, 7), "[...]\nbb\nccc\n")
+        self.assertEqual(fmap_planner._log_tail(lines, 4), "[...]\nccc\n")
+        # A line longer than the limit is cut
+        self.assertEqual(fmap_planner._log_tail(lines, 2), "[...]c\n")
+
+    def test_tmp_root(self):
+        mounts = "tmpfs /fmap/ram tmpfs rw 0 0\n/dev/sda1 /fmap ext4 rw 0 0\n"
+        with mock.patch("builtins.open", mock.mock_open(read_data=mounts)):
+            self.assertTrue(fmap_planner._is_tmpfs("/fmap/ram/tmp"))
+            self.assertFalse(fmap_planner._is_tmpfs("/fmap/disk"))
+        with tempfile.TemporaryDirectory() as tempdir:
+            with mock.patch.dict(os.environ, {"UP_FMAP_TMPDIR": tempdir}):
+                self.assertEqual(fmap_planner._best_tmp_root(), tempdir)
+            missing = os.path.join(tempdir, "missing")
+            with mock.patch.dict(os.environ, {"UP_FMAP_TMPDIR": missing}):
+                with self.assertWarns(UserWarning):
+                    tmp_root = fmap_planner._best_tmp_root()
+                self.assertEqual(tmp_root, fmap_planner._ram_tmp_root())
+
+    def test_pddl_cache(self):
+        problem = get_depot_problem()
+        FMAPsolver.clear_cache()
+        self.assertIsNone(_cached_pddl(problem))
+        entry = _serialize_pddl(problem)
+        self.assertIs(_cached_pddl(problem), entry)
+        with tempfile.TemporaryDirectory() as tempdir:
+            domain_dir = os.path.join(tempdir, "domain_pddl")
+            problem_dir = os.path.join(tempdir, "problem_pddl")
+            _materialize_pddl(entry, domain_dir, problem_dir)
+            self.assertEqual(len(os.listdir(domain_dir)), len(problem.agents))
+            self.assertEqual(len(os.listdir(problem_dir)), len(problem.agents))
+        problem.clear_goals()
+        self.assertIsNone(_cached_pddl(problem))
+        FMAPsolver.clear_cache()
+
+    @skipIf(sys.platform == "win32", "the stub java is a shell script")
+    def test_plan_cache(self):
+        problem = get_depot_problem()
+        with FMAPsolver(plan_cache=True) as planner:
+            with stub_java(STUB_PLAN):
+                planner.solve(problem)
+            # FMAP can not run anymore, the plans come from the cache and
+            # refer to the items of the solved problem instance
+            for p in (problem, get_depot_problem()):
+                result = planner.solve(p)
+                self.assertEqual(
+                    result.status, PlanGenerationResultStatus.SOLVED_SATISFICING
+                )
+                for ai in result.plan.get_adjacency_list:
+                    self.assertIs(ai.agent, p.agent(ai.agent.name))
+                    self.assertTrue(any(a is ai.action for a in ai.agent.actions))
+
+    def test_plan_from_lines(self):
+        problem = get_depot_problem()
+        w = _serialize_pddl(problem)[1]
+        planner = FMAPsolver()
+        plan_lines = _match_plan_lines(
+            b"; Solution plan\n"
+            b"0: (drive driver0_agent truck0 distributor1_place depot0_place)\n"
+            b"1: (lift depot0_agent depot0_place hoist0 crate1 pallet0)\n"
+        )
+        plan = planner._plan_from_lines(problem, plan_lines, w.get_item_named)
+        self.assertEqual(len(plan.get_adjacency_list), 2)
+        plan = planner._plan_from_lines(problem, [], w.get_item_named)
+        self.assertEqual(len(plan.get_adjacency_list), 0)
@@ -1,15 +1,23 @@
-import pkg_resources  # type: ignore
 import unified_planning as up  # type: ignore
 from unified_planning.model import ProblemKind  # type: ignore
 from unified_planning.engines import Engine, Credits, LogMessage  # type: ignore
 from unified_planning.engines.mixins import OneshotPlannerMixin  # type: ignore
-from typing import Callable, Dict, IO, List, Optional, Set, Union, cast  # type: ignore
+from typing import Callable, Dict, IO, List, Optional, Set, Tuple, Union, cast  # type: ignore
 from unified_planning.io.ma_pddl_writer import MAPDDLWriter  # type: ignore
+import atexit
+import functools
+import importlib.resources
+import json
+import hashlib
+import inspect
 import tempfile
 import time
 import os
+import shutil
 import subprocess
 import sys
+import threading
+import warnings
 import asyncio
 from unified_planning.engines.pddl_planner import (
     run_command_asyncio,
@@ -25,7 +33,19 @@ from unified_planning.engines.results import (
 from unified_planning.model.multi_agent import MultiAgentProblem  # type: ignore
 import re
 from unified_planning.plans.partial_order_plan import PartialOrderPlan
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from itertools import chain
+
+# Recent versions of unified_planning pass to the command runners the engine
+# that starts the process (stored in its _process attribute)
+_RUNNERS_TAKE_ENGINE = (
+    "engine" in inspect.signature(run_command_posix_select).parameters
+)
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None  # type: ignore
 
 credits = Credits(
     "FMAP",
@@ -38,19 +58,605 @@ credits = Credits(
 )
 
 
+def _resource_path(resource: str) -> str:
+    try:
+        path = importlib.resources.files("up_fmap").joinpath(resource)
+        return os.fspath(path)  # type: ignore
+    except (AttributeError, TypeError):
+        # Old python versions or package not installed as plain files
+        import pkg_resources  # type: ignore
+
+        return pkg_resources.resource_filename("up_fmap", resource)
+
+
+# The jar is looked up once, when the module is imported
+_FMAP_JAR = _resource_path("FMAP/FMAP.jar")
+_FMAP_JAR_FOUND = os.path.isfile(_FMAP_JAR)
+
+_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "up_fmap",
+)
+
+# Options of the JVM started for every solve: FMAP runs are usually short, so
+# the JIT compilation is limited to the C1 compiler
+_JVM_ARGS = ["-Xshare:auto", "-XX:TieredStopAtLevel=1"]
+
+
+def _java_id(java: str) -> str:
+    """
+    Returns a hash identifying the given java installation (its java
+    executable and release file).
+    """
+    h = hashlib.blake2b(digest_size=8)
+    try:
+        st = os.stat(java)
+        h.update(f"{java}\0{st.st_size}\0{int(st.st_mtime)}\0".encode())
+        with open(_java_release_file(java), "rb") as f:
+            h.update(f.read())
+    except OSError:
+        pass
+    return h.hexdigest()
+
+
+def _java_release_file(java: str) -> str:
+    return os.path.join(os.path.dirname(os.path.dirname(java)), "release")
+
+
+@functools.lru_cache(maxsize=None)
+def _java_version(java: str) -> Optional[int]:
+    """
+    Returns the major version of the given java executable (8 for java 1.8),
+    read from the release file of its installation or from `java -version`,
+    or None if it can not be found.
+    """
+    try:
+        with open(_java_release_file(java), "rb") as f:
+            match = re.search(rb'^JAVA_VERSION="(?:1\.)?(\d+)', f.read(), re.MULTILINE)
+        if match is not None:
+            return int(match.group(1))
+    except OSError:
+        pass
+    try:
+        res = subprocess.run([java, "-version"], capture_output=True, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(rb'version "(?:1\.)?(\d+)', res.stderr + res.stdout)
+    return int(match.group(1)) if match is not None else None
+
+
+def _cds_archive() -> Optional[str]:
+    """
+    Returns the path of the AppCDS archive of FMAP classes, specific to the
+    installed FMAP.jar and java, or None if java is older than 13 (or not
+    found) or if the cache directory can not be created.
+    """
+    java = shutil.which("java")
+    if java is None:
+        return None
+    java = os.path.realpath(java)
+    version = _java_version(java)
+    if version is None or version < 13:
+        warnings.warn("cds_cache is ignored, as it requires java 13 or later")
+        return None
+    jar = os.path.realpath(_FMAP_JAR)
+    try:
+        st = os.stat(jar)
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+    except OSError:
+        return None
+    h = hashlib.blake2b(f"{jar}\0{_java_id(java)}".encode(), digest_size=8)
+    name = f"FMAP-{st.st_size}-{int(st.st_mtime)}-{h.hexdigest()}.jsa"
+    return os.path.join(_CACHE_DIR, name)
+
+
+def _cds_dump_path(cds_archive: str) -> str:
+    # The archive is dumped in a file private to the calling thread and then
+    # atomically renamed, so concurrent solves never read a partial archive
+    return f"{cds_archive}.{os.getpid()}-{threading.get_ident()}"
+
+
+# Serialized MA-PDDL of the last problems solved, keyed by id(problem).
+# Each entry stores the hash of the problem at serialization time (used to
+# detect mutations), the writer (needed for the renamings), the encoded domain
+# and problem of every agent and the digest of all of them. The writer keeps
+# its problem alive, so the cache is bounded and the least recently used entry
+# is evicted first (FMAPsolver.clear_cache releases all of them). The lock
+# guards the cache against solves running in different threads.
+_PddlCacheEntry = Tuple[int, MAPDDLWriter, Dict[str, bytes], Dict[str, bytes], str]
+_PDDL_CACHE: "OrderedDict[int, _PddlCacheEntry]" = OrderedDict()
+_PDDL_CACHE_SIZE = 16
+_PDDL_CACHE_LOCK = threading.Lock()
+
+
+# A plan line, e.g. "0: (action agent param1 param2)"; whitespace does not
+# match newlines, so that the regex can be applied to the whole FMAP output
+_PLAN_LINE_RE = re.compile(
+    rb"^(\d*).+\((\S*)[^\S\n]([^)\s]+)(?:[^\S\n](.+))?\)", re.MULTILINE
+)
+
+
+# The timestamp, action, agent and parameters of a plan line
+_PlanLine = Tuple[str, str, str, Optional[str]]
+
+
+def _match_plan_lines(data: bytes) -> List[_PlanLine]:
+    """
+    Returns the timestamp, action, agent and parameters (lowercase) of every
+    plan line in the given FMAP output.
+    """
+    matches = [m.groups() for m in _PLAN_LINE_RE.finditer(data)]
+    return [
+        (
+            timestamp.decode(),
+            action.decode().lower(),
+            agent.decode().lower(),
+            params.decode().lower() if params else None,
+        )
+        for timestamp, action, agent, params in matches
+    ]
+
+
+def _log_tail(lines: List[str], max_chars: Optional[int]) -> str:
+    """
+    Joins the last lines of an output, keeping at most max_chars characters
+    (all of them if max_chars is None). A cut output starts with "[...]".
+    """
+    if max_chars is None:
+        return "".join(lines)
+    tail: "deque[str]" = deque()
+    size = 0
+    for line in reversed(lines):
+        if size + len(line) > max_chars:
+            # The oldest line kept is cut to its last characters
+            kept = max_chars - size
+            tail.appendleft(line[len(line) - kept :] if kept else "\n")
+            tail.appendleft("[...]")
+            break
+        size += len(line)
+        tail.appendleft(line)
+    return "".join(tail)
+
+
+def _is_tmpfs(path: str) -> bool:
+    """Returns True if the given directory is on a RAM-backed filesystem."""
+    path = os.path.realpath(path)
+    mount_point, fs_type = "", ""
+    try:
+        with open("/proc/self/mounts") as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mp = fields[1].replace("\\040", " ")
+                inside = path == mp or path.startswith(mp.rstrip("/") + "/")
+                if inside and len(mp) >= len(mount_point):
+                    mount_point, fs_type = mp, fields[2]
+    except OSError:
+        return False
+    return fs_type in ("tmpfs", "ramfs")
+
+
+@functools.lru_cache(maxsize=None)
+def _ram_tmp_root() -> Optional[str]:
+    if not sys.platform.startswith("linux"):
+        return None
+    for candidate in (
+        tempfile.gettempdir(),
+        "/dev/shm",
+        os.environ.get("XDG_RUNTIME_DIR"),
+    ):
+        if (
+            candidate
+            and os.path.isdir(candidate)
+            and os.access(candidate, os.W_OK | os.X_OK)
+            and _is_tmpfs(candidate)
+        ):
+            return candidate
+    return None
+
+
+def _best_tmp_root() -> Optional[str]:
+    """
+    Returns the directory where the temporary files of a solve are created:
+    the UP_FMAP_TMPDIR environment variable if set (and a writable directory),
+    otherwise the first RAM-backed directory among the default temporary
+    directory, /dev/shm and $XDG_RUNTIME_DIR. None (the tempfile default) is
+    returned if none of them is RAM-backed.
+    """
+    override = os.environ.get("UP_FMAP_TMPDIR")
+    if override:
+        if os.path.isdir(override) and os.access(override, os.W_OK | os.X_OK):
+            return override
+        warnings.warn(
+            f"UP_FMAP_TMPDIR={override} is not a writable directory, using the default"
+        )
+    return _ram_tmp_root()
+
+
+def _write_file(path: str, data: bytes):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+class _EventLoopHolder:
+    """Owns the windows event loop of a thread, closed with the holder."""
+
+    def __init__(self):
+        self.loop = asyncio.ProactorEventLoop()  # type: ignore
+
+    def __del__(self):
+        self.loop.close()
+
+
+# Event loops used to run FMAP on windows, one per thread, created on first
+# use. The holder of a thread's loop is released (and the loop closed) when
+# the thread finishes; the loop of the main thread is closed at exit
+_event_loops = threading.local()
+
+
+def _proactor_event_loop() -> asyncio.AbstractEventLoop:
+    """Returns the windows event loop of the calling thread."""
+    holder = getattr(_event_loops, "holder", None)
+    if holder is None or holder.loop.is_closed():
+        holder = _event_loops.holder = _EventLoopHolder()
+    return holder.loop
+
+
+@atexit.register
+def _close_event_loop():
+    holder = getattr(_event_loops, "holder", None)
+    if holder is not None:
+        holder.loop.close()
+
+
+class _NullOutput:
+    """Output stream discarding what is written to it."""
+
+    def write(self, data: str) -> int:
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _FifoFeeder:
+    """
+    Writes files as named pipes fed by background threads, so that the reader
+    gets the data without it going through the filesystem.
+    """
+
+    def __init__(self):
+        self._feeds: List[Tuple[str, threading.Thread]] = []
+
+    def write(self, path: str, data: bytes):
+        os.mkfifo(path, 0o600)
+        feed = threading.Thread(target=self._feed, args=(path, data), daemon=True)
+        feed.start()
+        self._feeds.append((path, feed))
+
+    @staticmethod
+    def _feed(path: str, data: bytes):
+        try:
+            _write_file(path, data)
+        except OSError:
+            # The reader closed the pipe before reading everything
+            pass
+
+    def close(self):
+        """Unblocks and joins the threads whose pipe was not (fully) read."""
+        for path, feed in self._feeds:
+            while feed.is_alive():
+                try:
+                    os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                feed.join(0.1)
+        self._feeds = []
+
+
+def _problem_version(problem: MultiAgentProblem) -> int:
+    """Returns a cheap hash of the problem, that changes when the problem is modified."""
+    res = hash(problem.name) + hash(problem.ma_environment)
+    for ag in problem.agents:
+        res += hash(ag)
+    for ut in problem.user_types:
+        res += hash(ut)
+    for o in problem.all_objects:
+        res += hash(o)
+    for iv in problem.explicit_initial_values.items():
+        res += hash(iv)
+    for g in problem.goals:
+        res += hash(g)
+    return res
+
+
+def _cached_pddl(problem: MultiAgentProblem) -> Optional[_PddlCacheEntry]:
+    """
+    Returns the in-memory cache entry of the given problem, if still valid.
+    The problem is only hashed if an entry was stored for it.
+    """
+    with _PDDL_CACHE_LOCK:
+        entry = _PDDL_CACHE.get(id(problem))
+    if (
+        entry is None
+        or entry[1].problem is not problem
+        or entry[0] != _problem_version(problem)
+    ):
+        return None
+    with _PDDL_CACHE_LOCK:
+        if id(problem) in _PDDL_CACHE:
+            _PDDL_CACHE.move_to_end(id(problem))
+    return entry
+
+
+def _serialize_pddl(problem: MultiAgentProblem) -> _PddlCacheEntry:
+    """
+    Serializes the given problem to MA-PDDL and stores the result in the
+    in-memory cache, where _cached_pddl finds it while the problem is not
+    modified.
+
+    :param problem: The MultiAgentProblem to serialize.
+    :return: The version of the problem, the MAPDDLWriter holding the
+        renamings, the encoded domain and problem of every agent and their
+        digest.
+    """
+    w = MAPDDLWriter(problem, explicit_false_initial_states=True)
+    domains, problems, digest = _encode_pddl(w.get_ma_domains(), w.get_ma_problems())
+    # The writer may store the default initial values in the problem, so the
+    # version is taken after the serialization
+    entry = (_problem_version(problem), w, domains, problems, digest)
+    with _PDDL_CACHE_LOCK:
+        _PDDL_CACHE[id(problem)] = entry
+        _PDDL_CACHE.move_to_end(id(problem))
+        if len(_PDDL_CACHE) > _PDDL_CACHE_SIZE:
+            _PDDL_CACHE.popitem(last=False)
+    return entry
+
+
+def _encode_pddl(
+    domains: Dict[str, str], problems: Dict[str, str]
+) -> Tuple[Dict[str, bytes], Dict[str, bytes], str]:
+    """
+    Encodes the MA-PDDL text of all the agents, hashing the bytes in the same
+    pass, so that the plan cache key costs no extra read of the text.
+
+    :return: The encoded domains and problems and the digest of all of them.
+    """
+    h = hashlib.blake2b()
+    encoded_domains: Dict[str, bytes] = {}
+    encoded_problems: Dict[str, bytes] = {}
+    for ag, domain in domains.items():
+        encoded_domains[ag] = domain.encode()
+        encoded_problems[ag] = problems[ag].encode()
+        for data in (ag.encode(), encoded_domains[ag], encoded_problems[ag]):
+            h.update(data)
+            h.update(b"\0")
+    return encoded_domains, encoded_problems, h.hexdigest()
+
+
+def _problem_fingerprint(problem: MultiAgentProblem) -> str:
+    """
+    Returns a hash of the problem content that, unlike _problem_version, is
+    the same in different python processes.
+    """
+    items: List[object] = [up.__version__, problem.name]
+    items += [problem.ma_environment.fluents, problem.ma_environment.fluents_defaults]
+    items += problem.user_types
+    for ag in problem.agents:
+        items += [ag, ag.fluents_defaults]
+    items += [f"{o} - {o.type}" for o in problem.all_objects]
+    items += sorted(f"{f} := {v}" for f, v in problem.explicit_initial_values.items())
+    items += problem.goals
+    h = hashlib.blake2b()
+    for item in items:
+        h.update(str(item).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _disk_cache_lookup(fingerprint: str) -> Optional[str]:
+    """
+    Returns the on-disk cache directory of the given fingerprint, if stored.
+    The directories of the entries compressed with zstd end with ".zst" and
+    are only used when zstandard is installed.
+    """
+    names = [f"{fingerprint}.zst", fingerprint] if zstandard else [fingerprint]
+    for name in names:
+        dirname = os.path.join(_CACHE_DIR, "pddl", name)
+        if os.path.isfile(os.path.join(dirname, "ready")):
+            return dirname
+    return None
+
+
+def _write_zstd(path: str, data: bytes):
+    """Writes the given data compressed with zstd in path + ".zst"."""
+    # A compressor can not be shared by concurrent solves
+    _write_file(f"{path}.zst", zstandard.ZstdCompressor(level=3).compress(data))
+
+
+# The items named in a plan
+_PlanItem = Union["up.model.Action", "up.model.Object", "up.model.multi_agent.Agent"]
+
+
+def _load_disk_cache(
+    problem: MultiAgentProblem, dirname: str
+) -> Tuple[str, Callable[[str], _PlanItem], Optional[Dict[str, bytes]]]:
+    """
+    Reads an entry of the on-disk MA-PDDL cache. Any exception raised means
+    that the entry is damaged (or was deleted meanwhile).
+
+    :return: The digest of the MA-PDDL text, a function mapping the names
+        used in the MA-PDDL to the items of the given problem and, for the
+        entries compressed with zstd, the decompressed content of the MA-PDDL
+        files, keyed by their path relative to the entry directory.
+    """
+    with open(os.path.join(dirname, "names.json")) as f:
+        data = json.load(f)
+    names: Dict[str, str] = data["names"]
+    files: Optional[Dict[str, bytes]] = None
+    if dirname.endswith(".zst"):
+        files = {}
+        dctx = zstandard.ZstdDecompressor()
+    for subdir in ("domain_pddl", "problem_pddl"):
+        filenames = os.listdir(os.path.join(dirname, subdir))
+        if len(filenames) != len(problem.agents):
+            raise ValueError(f"Incomplete MA-PDDL cache entry {dirname}")
+        if files is not None:
+            for filename in filenames:
+                with open(os.path.join(dirname, subdir, filename), "rb") as zst:
+                    path = os.path.join(subdir, filename[: -len(".zst")])
+                    files[path] = dctx.decompress(zst.read())
+    items: Dict[str, _PlanItem] = {o.name: o for o in problem.all_objects}
+    for ag in problem.agents:
+        items.setdefault(ag.name, ag)
+        for a in ag.actions:
+            items.setdefault(a.name, a)
+
+    def get_item_named(name: str) -> _PlanItem:
+        try:
+            return items[names[name]]
+        except KeyError:
+            raise up.exceptions.UPException(
+                f"The name {name} does not correspond to any item."
+            )
+
+    return data["digest"], get_item_named, files
+
+
+def _store_disk_cache(entry: _PddlCacheEntry, fingerprint: str):
+    """
+    Stores the MA-PDDL of the given in-memory cache entry, with the given
+    problem fingerprint, in the on-disk cache, compressed
+    with zstd if zstandard is installed. The entry is written in a staging
+    directory that is atomically renamed when complete.
+    """
+    parent = os.path.join(_CACHE_DIR, "pddl")
+    dirname = os.path.join(parent, f"{fingerprint}.zst" if zstandard else fingerprint)
+    if os.path.isdir(dirname):
+        return
+    staging = None
+    try:
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent, prefix=f".{fingerprint}-")
+        _materialize_pddl(
+            entry,
+            os.path.join(staging, "domain_pddl"),
+            os.path.join(staging, "problem_pddl"),
+            _write_zstd if zstandard else _write_file,
+        )
+        _, w, _, _, pddl_digest = entry
+        names = {
+            name: item.name
+            for name, item in w.nto_renamings.items()
+            if isinstance(
+                item,
+                (up.model.Action, up.model.Object, up.model.multi_agent.Agent),
+            )
+        }
+        with open(os.path.join(staging, "names.json"), "w") as f:
+            json.dump({"digest": pddl_digest, "names": names}, f)
+        open(os.path.join(staging, "ready"), "w").close()
+        os.rename(staging, dirname)
+    except OSError:
+        # The cache is not writable, or another process stored the entry first
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def _materialize_pddl(
+    entry: _PddlCacheEntry,
+    domain_dirname: str,
+    problem_dirname: str,
+    write: Callable[[str, bytes], None] = _write_file,
+):
+    """
+    Writes the MA-PDDL domains and problems of an in-memory cache entry in the
+    given directories.
+
+    :param entry: The entry returned by _serialize_pddl or _cached_pddl.
+    :param domain_dirname: The directory where the agents' domains are written.
+    :param problem_dirname: The directory where the agents' problems are written.
+    :param write: The function used to write the content of every file.
+    """
+    _, _, domains, problems, _ = entry
+    os.makedirs(domain_dirname, exist_ok=True)
+    os.makedirs(problem_dirname, exist_ok=True)
+
+    # The files are small: writing them from a thread pool is slower than
+    # writing them one after the other
+    for ag in domains:
+        write(os.path.join(domain_dirname, f"{ag}_domain.pddl"), domains[ag])
+        write(os.path.join(problem_dirname, f"{ag}_problem.pddl"), problems[ag])
+
+
+def _build_supported_kind() -> "ProblemKind":
+    supported_kind = ProblemKind(version=2)
+    supported_kind.set_problem_class("ACTION_BASED_MULTI_AGENT")
+    supported_kind.set_typing("FLAT_TYPING")
+    supported_kind.set_typing("HIERARCHICAL_TYPING")
+    supported_kind.set_conditions_kind("NEGATIVE_CONDITIONS")
+    supported_kind.set_conditions_kind("EQUALITIES")
+    supported_kind.set_fluents_type("OBJECT_FLUENTS")
+    return supported_kind
+
+
+# Built once, as supports() is called for every solve
+_SUPPORTED_KIND = _build_supported_kind()
+
+
 class FMAPsolver(Engine, OneshotPlannerMixin):
     def __init__(
-        self, search_algorithm: Optional[str] = None, heuristic: Optional[str] = None
+        self,
+        search_algorithm: Optional[str] = None,
+        heuristic: Optional[str] = None,
+        named_pipes: bool = False,
+        plan_cache: bool = False,
+        plan_cache_size: int = 128,
+        disk_cache: bool = False,
+        max_log_chars: Optional[int] = 1 << 20,
+        jvm_args: Optional[List[str]] = None,
+        cds_cache: bool = False,
     ):
         Engine.__init__(self)
         OneshotPlannerMixin.__init__(self)
         self.search_algorithm = search_algorithm
         self.heuristic = heuristic
+        # On Linux, give the MA-PDDL to FMAP through named pipes instead of files
+        self.named_pipes = named_pipes and sys.platform.startswith("linux")
+        # Plan lines of the solved problems, keyed by the hash of their MA-PDDL
+        self.plan_cache = plan_cache
+        self.plan_cache_size = plan_cache_size
+        self._plan_cache: "OrderedDict[str, List[_PlanLine]]" = OrderedDict()
+        # The FMAP process started by the unified_planning command runners
+        self._process = None
+        # Keep the MA-PDDL of the solved problems in the user cache directory
+        self.disk_cache = disk_cache
+        # Only the tail of FMAP output and error is kept in the log messages (the
+        # whole output is still captured while FMAP runs, to parse the plan)
+        self.max_log_chars = max_log_chars
+        self.jvm_args = _JVM_ARGS if jvm_args is None else jvm_args
+        # Keep an AppCDS archive of FMAP classes in the user cache directory
+        self.cds_cache = cds_cache
 
     @property
     def name(self) -> str:
         return "FMAP"
 
+    @staticmethod
+    def clear_cache():
+        """Forgets the MA-PDDL serialized by previous calls to solve."""
+        with _PDDL_CACHE_LOCK:
+            _PDDL_CACHE.clear()
+
+    def _plan_cache_key(self, pddl_digest: str) -> str:
+        return f"{pddl_digest}:{self.search_algorithm}:{self.heuristic}"
+
     def _manage_parameters(self, command):
         if self.search_algorithm is not None:
             command += ["-s", self.search_algorithm]
@@ -59,23 +665,50 @@ class FMAPsolver(Engine, OneshotPlannerMixin):
         return command
 
     def _get_cmd_ma(
+        self,
+        problem: MultiAgentProblem,
+        domain_filename: str,
+        problem_filename: str,
+        cds_archive: Optional[str] = None,
+    ):
+        base_command = ["java"] + self.jvm_args
+        if cds_archive is not None:
+            # The archive is used if it exists, otherwise it is dumped when the
+            # JVM exits (_cds_archive checks that java is 13 or later, as the
+            # -Xlog options make older JVMs fail)
+            if os.path.isfile(cds_archive):
+                cds_option = f"-XX:SharedArchiveFile={cds_archive}"
+            else:
+                dump = _cds_dump_path(cds_archive)
+                cds_option = f"-XX:ArchiveClassesAtExit={dump}"
+            # The CDS warnings are printed on the standard error, as the
+            # standard output is scanned for the plan and for errors
+            base_command += [
+                "-XX:+IgnoreUnrecognizedVMOptions",
+                cds_option,
+                "-Xlog:disable",
+                "-Xlog:all=warning:stderr",
+            ]
+        base_command += ["-jar", _FMAP_JAR]
+        return base_command + self._get_args_ma(
+            problem, domain_filename, problem_filename
+        )
+
+    def _get_args_ma(
         self, problem: MultiAgentProblem, domain_filename: str, problem_filename: str
     ):
-        base_command = [
-            "java",
-            "-jar",
-            pkg_resources.resource_filename("up_fmap", "FMAP/FMAP.jar"),
-        ]
-        for ag in problem.agents:
-            base_command.extend(
-                [
+        domain_prefix = os.path.join(domain_filename, "")
+        problem_prefix = os.path.join(problem_filename, "")
+        base_command = list(
+            chain.from_iterable(
+                (
                     f"{ag.name}_type",
-                    os.path.join(domain_filename, f"{ag.name}_domain.pddl"),
-                ]
-            )
-            base_command.extend(
-                [os.path.join(problem_filename, f"{ag.name}_problem.pddl")]
+                    f"{domain_prefix}{ag.name}_domain.pddl",
+                    f"{problem_prefix}{ag.name}_problem.pddl",
+                )
+                for ag in problem.agents
             )
+        )
         return self._manage_parameters(base_command)
 
     def _result_status(
@@ -94,18 +727,11 @@ class FMAPsolver(Engine, OneshotPlannerMixin):
 
     @staticmethod
     def supported_kind() -> "ProblemKind":
-        supported_kind = ProblemKind(version=2)
-        supported_kind.set_problem_class("ACTION_BASED_MULTI_AGENT")
-        supported_kind.set_typing("FLAT_TYPING")
-        supported_kind.set_typing("HIERARCHICAL_TYPING")
-        supported_kind.set_conditions_kind("NEGATIVE_CONDITIONS")
-        supported_kind.set_conditions_kind("EQUALITIES")
-        supported_kind.set_fluents_type("OBJECT_FLUENTS")
-        return supported_kind
+        return _SUPPORTED_KIND
 
     @staticmethod
     def supports(problem_kind: "ProblemKind") -> bool:
-        return problem_kind <= FMAPsolver.supported_kind()
+        return problem_kind <= _SUPPORTED_KIND
 
     @staticmethod
     def get_credits(**kwargs) -> Optional["Credits"]:
@@ -125,86 +751,147 @@ class FMAPsolver(Engine, OneshotPlannerMixin):
         )
         if heuristic is not None:
             raise up.exceptions.UPUsageError('Custom heuristic is not supported!')
+        if self.named_pipes and timeout is None:
+            # FMAP would block forever if it opened a pipe a second time
+            raise up.exceptions.UPUsageError("named_pipes requires a timeout")
+        # The MA-PDDL is taken from the in-memory cache (serializing the problem
+        # if needed) or, when enabled and stored, from the on-disk cache
+        entry = _cached_pddl(problem)
+        fingerprint, cache_dirname, pddl_digest = None, None, None
+        cache_files = None
+        if entry is None and self.disk_cache:
+            fingerprint = _problem_fingerprint(problem)
+            cache_dirname = _disk_cache_lookup(fingerprint)
+        if cache_dirname is not None:
+            try:
+                pddl_digest, get_item_named, cache_files = _load_disk_cache(
+                    problem, cache_dirname
+                )
+            except Exception:
+                # A damaged entry is a cache miss, and it is stored again
+                shutil.rmtree(cache_dirname, ignore_errors=True)
+                cache_dirname = None
+        if cache_dirname is None:
+            if entry is None:
+                entry = _serialize_pddl(problem)
+            _, w, _, _, pddl_digest = entry
+            get_item_named = w.get_item_named
+        plan_cache_key = None
+        if self.plan_cache:
+            assert pddl_digest is not None
+            plan_cache_key = self._plan_cache_key(pddl_digest)
+            if plan_cache_key in self._plan_cache:
+                # The plan is rebuilt with the items of the given problem, that
+                # may be a different instance than the one that was solved
+                self._plan_cache.move_to_end(plan_cache_key)
+                plan_lines = self._plan_cache[plan_cache_key]
+                return PlanGenerationResult(
+                    PlanGenerationResultStatus.SOLVED_SATISFICING,
+                    self._plan_from_lines(problem, plan_lines, get_item_named),
+                    engine_name=self.name,
+                )
+        if not _FMAP_JAR_FOUND:
+            raise up.exceptions.UPException(f"FMAP jar not found in {_FMAP_JAR}")
         plan = None
+        plan_lines = []
         logs: List["up.engines.results.LogMessage"] = []
-        with tempfile.TemporaryDirectory() as tempdir:
-            w = MAPDDLWriter(problem, explicit_false_initial_states=True)
-            domain_filename = os.path.join(tempdir, "domain_pddl")
-            problem_filename = os.path.join(tempdir, "problem_pddl")
-            plan_filename = os.path.join(tempdir, "plan.txt")
-            w.write_ma_domain(domain_filename)
-            w.write_ma_problem(problem_filename)
-            cmd = self._get_cmd_ma(problem, domain_filename, problem_filename)
+        with tempfile.TemporaryDirectory(
+            dir=_best_tmp_root(), prefix="fmap_"
+        ) as tempdir:
+            feeder = None
+            if cache_dirname is not None and cache_files is None:
+                domain_filename = os.path.join(cache_dirname, "domain_pddl")
+                problem_filename = os.path.join(cache_dirname, "problem_pddl")
+            else:
+                domain_filename = os.path.join(tempdir, "domain_pddl")
+                problem_filename = os.path.join(tempdir, "problem_pddl")
+                feeder = _FifoFeeder() if self.named_pipes else None
+                write = feeder.write if feeder is not None else _write_file
+                if cache_files is not None:
+                    # Compressed entries are decompressed in the temporary directory
+                    os.makedirs(domain_filename)
+                    os.makedirs(problem_filename)
+                    for path, data in cache_files.items():
+                        write(os.path.join(tempdir, path), data)
+                else:
+                    assert entry is not None
+                    _materialize_pddl(entry, domain_filename, problem_filename, write)
             start = time.time()
-            if output_stream is None:
-                # If we do not have an output stream to write to, we simply call
-                # a subprocess and retrieve the final output and error with communicate
-                process = subprocess.Popen(
-                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            timeout_occurred: bool = False
+            proc_out: List[str] = []
+            proc_err: List[str] = []
+            try:
+                cds_archive = _cds_archive() if self.cds_cache else None
+                cmd = self._get_cmd_ma(
+                    problem, domain_filename, problem_filename, cds_archive
                 )
-                timeout_occurred: bool = False
-                proc_out: List[str] = []
-                proc_err: List[str] = []
-                try:
-                    out_err_bytes = process.communicate(timeout=timeout)
-                    proc_out, proc_err = [[x.decode()] for x in out_err_bytes]
-                except subprocess.TimeoutExpired:
-                    timeout_occurred = True
-                retval = process.returncode
-            else:
-                if sys.platform == "win32":
-                    # On windows we have to use asyncio (does not work inside notebooks)
+                runner_args = [self, cmd] if _RUNNERS_TAKE_ENGINE else [cmd]
+                if output_stream is None and sys.platform != "win32":
+                    # If we do not have an output stream to write to, we simply call
+                    # a subprocess and retrieve the final output and error with
+                    # communicate, that reads both pipes with a selector on posix
+                    process = subprocess.Popen(
+                        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                    )
                     try:
-                        loop = asyncio.ProactorEventLoop()
-                        exec_res = loop.run_until_complete(
-                            run_command_asyncio(
-                                cmd, output_stream=output_stream, timeout=timeout
-                            )
-                        )
-                    finally:
-                        loop.close()
+                        out_err_bytes = process.communicate(timeout=timeout)
+                        proc_out, proc_err = [[x.decode()] for x in out_err_bytes]
+                    except subprocess.TimeoutExpired:
+                        timeout_occurred = True
+                        process.terminate()
+                        process.wait()
+                    retval = process.returncode
                 else:
-                    # On non-windows OSs, we can choose between asyncio and posix
-                    # select (see comment on USE_ASYNCIO_ON_UNIX variable for details)
-                    if USE_ASYNCIO_ON_UNIX:
-                        exec_res = asyncio.run(
+                    if sys.platform == "win32":
+                        # On windows we have to use asyncio (does not work inside notebooks).
+                        # It is also used without an output stream, as communicate would
+                        # start a thread per pipe: the output is then only captured in
+                        # proc_out and proc_err
+                        if output_stream is None:
+                            output_stream = cast(IO[str], _NullOutput())
+                        exec_res = _proactor_event_loop().run_until_complete(
                             run_command_asyncio(
-                                cmd, output_stream=output_stream, timeout=timeout
+                                *runner_args,
+                                output_stream=output_stream,
+                                timeout=timeout,
                             )
                         )
                     else:
-                        exec_res = run_command_posix_select(
-                            cmd, output_stream=output_stream, timeout=timeout
-                        )
-                timeout_occurred, (proc_out, proc_err), retval = exec_res
+                        # On non-windows OSs, we can choose between asyncio and posix
+                        # select (see comment on USE_ASYNCIO_ON_UNIX variable for details)
+                        if USE_ASYNCIO_ON_UNIX:
+                            exec_res = asyncio.run(
+                                run_command_asyncio(
+                                    *runner_args,
+                                    output_stream=output_stream,
+                                    timeout=timeout,
+                                )
+                            )
+                        else:
+                            exec_res = run_command_posix_select(
+                                *runner_args,
+                                output_stream=output_stream,
+                                timeout=timeout,
+                            )
+                    timeout_occurred, (proc_out, proc_err), retval = exec_res
+                if cds_archive is not None:
+                    dump = _cds_dump_path(cds_archive)
+                    if os.path.isfile(dump):
+                        if retval == 0 and not timeout_occurred:
+                            os.replace(dump, cds_archive)
+                        else:
+                            os.remove(dump)
+            finally:
+                if feeder is not None:
+                    feeder.close()
             solving_time = time.time() - start
 
-            f = open(plan_filename, "a+")
-            pattern = re.compile(r"[Ee]rror|[Ee]xception")
-            FAMP_error = False
-            for line in proc_out:
-                if pattern.search(line):
-                    FAMP_error = True
-                if not FAMP_error:
-                    f.write(line + "\n")
-            f.close()
-
-            logs.append(up.engines.results.LogMessage(LogLevel.INFO, "".join(proc_out)))
-            logs.append(
-                up.engines.results.LogMessage(LogLevel.ERROR, "".join(proc_err))
-            )
-
-            if not FAMP_error:
-                if os.path.isfile(plan_filename):
-                    plan = self._plan_from_file(
-                        problem, plan_filename, w.get_item_named
-                    )
-            else:
-                plan = None
+            out_log = _log_tail(proc_out, self.max_log_chars)
+            err_log = _log_tail(proc_err, self.max_log_chars)
+            logs.append(up.engines.results.LogMessage(LogLevel.INFO, out_log))
+            logs.append(up.engines.results.LogMessage(LogLevel.ERROR, err_log))
 
             if timeout_occurred and retval != 0:
-                process.terminate()
-                process.wait()
                 return PlanGenerationResult(
                     PlanGenerationResultStatus.TIMEOUT,
                     plan=None,
@@ -212,17 +899,43 @@ class FMAPsolver(Engine, OneshotPlannerMixin):
                     log_messages=logs,
                     engine_name=self.name,
                 )
+
+            # The plan is printed by FMAP in its output, before any error
+            pattern = re.compile(r"[Ee]rror|[Ee]xception")
+            FAMP_error = False
+            plan_out: List[str] = []
+            for line in proc_out:
+                if pattern.search(line):
+                    FAMP_error = True
+                    break
+                plan_out.append(line)
+
+            # The plan is only relevant if FMAP terminated correctly
+            if not FAMP_error and retval == 0:
+                plan_lines = _match_plan_lines("".join(plan_out).encode())
+                plan = self._plan_from_lines(problem, plan_lines, get_item_named)
         status: PlanGenerationResultStatus = self._result_status(
             problem, plan, retval, logs
         )
-        return PlanGenerationResult(
+        if fingerprint is not None and cache_dirname is None and retval == 0:
+            assert entry is not None
+            _store_disk_cache(entry, fingerprint)
+        result = PlanGenerationResult(
             status, plan, log_messages=logs, engine_name=self.name, metrics={"engine_internal_time": str(solving_time)}
         )
+        if (
+            plan_cache_key is not None
+            and status == PlanGenerationResultStatus.SOLVED_SATISFICING
+        ):
+            self._plan_cache[plan_cache_key] = plan_lines
+            if len(self._plan_cache) > self.plan_cache_size:
+                self._plan_cache.popitem(last=False)
+        return result
 
-    def _plan_from_file(
+    def _plan_from_lines(
         self,
         problem: "up.model.multi_agent.MultiAgentProblem",
-        plan_filename: str,
+        plan_lines: List[_PlanLine],
         get_item_named: Callable[
             [str],
             Union[
@@ -237,63 +950,41 @@ class FMAPsolver(Engine, OneshotPlannerMixin):
         ],
     ) -> "up.plans.Plan":
         """
-        Takes a problem, a filename and a map of renaming and returns the plan parsed from the file.
+        Takes a problem, the plan lines printed by FMAP and a map of renaming and returns the plan.
 
         :param problem: The up.model.problem.Problem instance for which the plan is generated.
-        :param plan_filename: The path of the file in which the plan is written.
+        :param plan_lines: The timestamp, action, agent and parameters of every plan line.
         :param get_item_named: A function that takes a name and returns the original up.model element instance
             linked to that renaming.
-        :return: The up.plans.Plan corresponding to the parsed plan from the file
+        :return: The up.plans.Plan corresponding to the given plan lines
         """
-        # ^(\d*).+\((\S*).+?(\S*).+?(.+(?=\)))
         dates_dict = defaultdict(list)
         adjacency_list = defaultdict(list)
-        with open(plan_filename) as plan:
-            for line in plan.readlines():
-                line = line.lower()
-                # match_line = re.match(r"^(\d*).+\((\S*).+?(\S*).+?(.+(?=\)))", line)
-                match_line = re.match(r"^(\d*).+\((\S*)\s([^)\s]+)(?:\s(.+))?\)", line)
-                if match_line:
-
-                    timestamp = match_line.group(1)
-                    action_name = match_line.group(2)
-                    agent_name = match_line.group(3)
-                    params_name = match_line.group(4)
-                    if params_name:
-                        params_name = params_name.split()
-                    else:
-                        params_name = []
-
-                    action = get_item_named(action_name)
-                    agent = get_item_named(agent_name)
-                    assert isinstance(
-                        action, up.model.Action
-                    ), "Wrong plan or renaming."
-                    parameters = []
-                    for p in params_name:
-                        obj = get_item_named(p)
-                        assert isinstance(
-                            obj, up.model.Object
-                        ), "Wrong plan or renaming."
-                        parameters.append(
-                            problem.environment.expression_manager.ObjectExp(obj)
-                        )
-                    act_instance = up.plans.ActionInstance(
-                        action, tuple(parameters), agent
-                    )
+        for timestamp, action_name, agent_name, params in plan_lines:
+            params_name = params.split() if params else []
+
+            action = get_item_named(action_name)
+            agent = get_item_named(agent_name)
+            assert isinstance(action, up.model.Action), "Wrong plan or renaming."
+            parameters = []
+            for p in params_name:
+                obj = get_item_named(p)
+                assert isinstance(obj, up.model.Object), "Wrong plan or renaming."
+                parameters.append(problem.environment.expression_manager.ObjectExp(obj))
+            act_instance = up.plans.ActionInstance(action, tuple(parameters), agent)
 
-                    dates_dict[timestamp].append(act_instance)
+            dates_dict[timestamp].append(act_instance)
 
-            dict_s = sorted(dates_dict.items(), key=lambda x: int(x[0]))
+        dict_s = sorted(dates_dict.items(), key=lambda x: int(x[0]))
 
-            for k, v in enumerate(dict_s):
-                index = k + 1
-                for action in v[1]:
-                    if index < len(dates_dict):
-                        next_action = dict_s[k + 1][1]
-                        adjacency_list[action].extend(next_action)
-                    elif len(dates_dict) == 1:
-                        adjacency_list[action] = []
+        for k, v in enumerate(dict_s):
+            index = k + 1
+            for action in v[1]:
+                if index < len(dates_dict):
+                    next_action = dict_s[k + 1][1]
+                    adjacency_list[action].extend(next_action)
+                elif len(dates_dict) == 1:
+                    adjacency_list[action] = []
 
         return up.plans.PartialOrderPlan(adjacency_list)
 